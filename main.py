@@ -5,23 +5,56 @@ LAN Music Server — single file
 - Recursive library (folders), per-folder Add/Shuffle
 - Shared server-side queue (add/remove/clear/next)
 - Global play/pause/seek that syncs to all listeners via SSE
-- Search box in control (client-side filtering)
+- Search box in control (server-side /search, first SEARCH_LIMIT matches)
 - Media served from ./music (relative paths preserved)
 
 Run:
-    pip install Flask
+    pip install Flask orjson   # orjson is optional (faster JSON)
+    pip install gevent         # optional: idle /events listeners become greenlets, not threads
     python app.py
+
+  or under gunicorn (one worker: state is in-process):
+    gunicorn -k gevent -w 1 -b 0.0.0.0:5000 main:app
+  Only plain 200 /media responses reach gunicorn's sendfile(2) there; <audio> asks for
+  Range: bytes=0-, and Werkzeug streams 206s through its own wrapper. For zero-copy
+  media, put nginx or Apache in front and set MEDIA_ACCEL_PREFIX or USE_X_SENDFILE.
 """
 from __future__ import annotations
+if __name__ == "__main__":
+    # run as a script: serve with gevent if installed; it must patch before anything else is imported
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        monkey = None
+import os
 import time
+import gzip
+import hashlib
+import hmac
 import json
 import random
-import queue
+import socket
+import tempfile
 import threading
+import zlib
+from collections import deque
+from functools import wraps
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import quote
+from typing import Deque, Dict, Any, List, NamedTuple, Optional, Tuple
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:  # stdlib fallback, same compact bytes output
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    _loads = json.loads  # accepts bytes too
 
-from flask import Flask, Response, request, jsonify, send_from_directory, abort, render_template_string
+from flask import Flask, Response, request, g, send_file, abort
 
 # ---------- Config ----------
 BASE = Path(__file__).resolve().parent
@@ -30,260 +63,745 @@ MUSIC_DIR.mkdir(exist_ok=True)
 HOST = "0.0.0.0"
 PORT = 5000
 ADMIN_TOKEN: Optional[str] = None  # set to a string to require ?token=... for admin routes
-AUDIO_EXTS = {".mp3", ".m4a", ".aac", ".ogg", ".oga", ".wav", ".flac"}
+# When behind nginx, set to an internal location aliased to MUSIC_DIR (e.g. "/_internal_music/")
+# so /media only validates the path and nginx sends the file:
+#   location /_internal_music/ { internal; alias /abs/path/to/music/; }
+MEDIA_ACCEL_PREFIX: Optional[str] = None
+CACHE_FILE = BASE / ".muslp-cache.json"  # last library scan, reloaded on startup
+# Behind Apache mod_xsendfile / lighttpd instead: Flask then answers /media with an
+# X-Sendfile header carrying the absolute path and the front-end server sends the file.
+USE_X_SENDFILE = False
+# Content-Type per extension, so /media never consults the system mimetypes DB
+AUDIO_MIME = {".mp3": "audio/mpeg", ".m4a": "audio/mp4", ".aac": "audio/aac", ".ogg": "audio/ogg",
+              ".oga": "audio/ogg", ".wav": "audio/wav", ".flac": "audio/flac"}
+AUDIO_EXTS = set(AUDIO_MIME)
+AUDIO_EXTS_TUPLE = tuple(AUDIO_EXTS)  # for str.endswith
+AUDIO_EXT_MAXLEN = max(map(len, AUDIO_EXTS))  # only this many trailing chars need lowering
 
 app = Flask(__name__)
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
 
 # ---------- Global state ----------
 state_lock = threading.Lock()
-_listeners: List[queue.Queue] = []
+
+# SSE fan-out: one shared ring buffer of encoded events; each /events stream keeps
+# a cursor into it. A client that falls more than EVENT_LOG_SIZE events behind is
+# told to resync instead of the server buffering for it.
+EVENT_LOG_SIZE = 256
+_events: Deque[Tuple[int, bytes]] = deque(maxlen=EVENT_LOG_SIZE)  # (seq, complete SSE frame)
+_events_seq = 0  # seq of the newest event; guarded by _events_cond
+_events_cond = threading.Condition()
+_state_seq = 0        # bumped per _set_state under state_lock
+_state_published = 0  # seq behind _STATE_REF; guarded by _events_cond
+_state_key: Tuple[Any, ...] = ()  # (track, paused, epoch, rounded anchor) last broadcast; under state_lock
 
 STATE: Dict[str, Any] = {
     "track": None,      # relative path like "folder/song.mp3"
     "paused": True,
     "position": 0.0,
     "updated": time.time(),
+    "epoch": 0,         # bumped whenever a new track starts; /ended must echo it
 }
 
-PLAYLIST_QUEUE: List[str] = []
-_track_started_at: Optional[float] = None
+PLAYLIST_QUEUE: Deque[str] = deque()
+_QUEUE_REV = 0  # bumped on every queue change
+_PLAYLIST_JSON = _dumps({"type": "playlist", "queue": []})  # last playlist event, reused for new listeners
+_BOOT_ID = int(time.time())  # keeps ETags from matching across restarts
+_track_started_at: Optional[float] = None  # time.monotonic() at position 0; None while paused
+
+class _StateRef(NamedTuple):
+    """Published read-only view of the playback state, replaced wholesale by _set_state()
+    (a single reference store), so readers never take state_lock."""
+    track: Optional[str]
+    paused: bool
+    position: float              # at `updated`; the live value while playing is now - started_at
+    updated: float
+    epoch: int
+    started_at: Optional[float]  # time.monotonic() at position 0; None while paused
+    rev: int                     # _set_state sequence number, for the /state ETag
+    encoded: bytes               # the state event as published
+
+_STATE_REF = _StateRef(None, True, 0.0, STATE["updated"], 0, None, 0, _dumps({"type": "state", **STATE}))
+
+# Library scan cache: rebuilt when MUSIC_DIR's mtime changes, on /rescan, and, if
+# DIR_CHECK_INTERVAL is set, when the periodic re-stat of every scanned directory finds
+# one changed (files added deeper down). That costs a stat per album directory each
+# interval, which adds up on NAS/SMB mounts, so it is off by default.
+DIR_CHECK_INTERVAL: Optional[float] = None  # e.g. 600.0; seconds between deep re-stats
+DIR_CHECK_YIELD = 64  # stats between yields, so a gevent server keeps serving meanwhile
+_PL_CACHE: Dict[str, Any] = {
+    "files": [],            # sorted relative paths
+    "set": frozenset(),     # same paths, for O(1) membership
+    "ndjson": [],           # tracks grouped by top-level folder, pre-encoded for /library, one line per folder
+    "lower": [],            # (path, path.lower()) pairs for /search
+    "mtime": None,
+    "dirs": {},             # absolute dir path -> mtime at scan time
+    "version": 0,           # bumped on every rebuild
+    "scanning": False,      # a walk is running (outside the lock)
+    "lock": threading.Lock(),
+}
 
 # ---------- Helpers ----------
-def discover_tracks() -> List[str]:
+def _json_response(obj: Any) -> Response:
+    """JSON response via _dumps (orjson when available) instead of Flask's encoder."""
+    return Response(_dumps(obj), mimetype="application/json")
+
+def _scan_tracks() -> Tuple[List[str], Dict[str, float]]:
+    """Walk MUSIC_DIR with os.scandir; DirEntry type checks avoid a stat per file.
+    Returns (tracks, {dir: mtime}); each dir is stat'ed before listing, so a later change shows."""
     out: List[str] = []
-    for p in MUSIC_DIR.rglob("*"):
-        if p.is_file() and p.suffix.lower() in AUDIO_EXTS:
-            rel = str(p.relative_to(MUSIC_DIR)).replace("\\", "/")
-            out.append(rel)
+    dirs: Dict[str, float] = {}
+    root = str(MUSIC_DIR)
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        if len(dirs) % DIR_CHECK_YIELD == 0:
+            time.sleep(0)  # yield: lets other greenlets run when gevent has patched time
+        try:
+            dirs[d] = os.stat(d).st_mtime
+            it = os.scandir(d)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if _utf8_name(e):
+                        stack.append(e.path)
+                elif e.name[-AUDIO_EXT_MAXLEN:].lower().endswith(AUDIO_EXTS_TUPLE) and e.is_file() \
+                        and _utf8_name(e):
+                    out.append(os.path.relpath(e.path, root).replace("\\", "/"))
     out.sort(key=str.lower)
-    return out
-
-def library_by_folder() -> Dict[str, List[str]]:
+    return out, dirs
+
+def _utf8_name(e: os.DirEntry) -> bool:
+    """False (and logged) for a name that is not valid UTF-8 on disk, e.g. Latin-1 from an
+    old Samba share: it decodes with surrogates, which the JSON encoders reject."""
+    try:
+        e.name.encode("utf-8")
+    except UnicodeEncodeError:
+        print(f"Skipping non-UTF-8 name: {e.path!r}")
+        return False
+    return True
+
+def _dirs_changed(dirs: Dict[str, float]) -> bool:
+    if not dirs:
+        return True  # nothing recorded (e.g. an older disk cache): treat as stale
+    for i, (d, m) in enumerate(dirs.items()):
+        if i % DIR_CHECK_YIELD == 0:
+            time.sleep(0)
+        try:
+            if os.stat(d).st_mtime != m:
+                return True
+        except OSError:
+            return True
+    return False
+
+def _store_scan(files: List[str], mtime: float, dirs: Dict[str, float]) -> bool:
+    """Install a scan result in the cache; caller holds the cache lock. True if the list changed."""
+    changed = files != _PL_CACHE["files"]
+    if changed:
+        # build everything first, so an error here leaves the previous scan intact
+        by_folder, lower = _index_tracks(files)
+        ndjson = [_dumps({"folder": k, "tracks": v}) + b"\n" for k, v in by_folder.items()]
+        _PL_CACHE.update(files=files, set=frozenset(files), lower=lower, ndjson=ndjson,
+                         version=_PL_CACHE["version"] + 1)
+    _PL_CACHE["mtime"] = mtime
+    _PL_CACHE["dirs"] = dirs
+    return changed
+
+def _music_mtime() -> float:
+    try:
+        return MUSIC_DIR.stat().st_mtime
+    except OSError:
+        return -1.0
+
+def discover_tracks(force: bool = False) -> List[str]:
+    """Return the cached track list, rescanning if MUSIC_DIR's own mtime changed or
+    force is set (deeper changes are found by the background _watch_dirs thread).
+    The walk runs outside the cache lock; while it does, other callers get the previous
+    lists, and a second walk is not started. Request handlers use track_set() instead,
+    which never walks; only the watcher thread and /rescan call this."""
+    mtime = _music_mtime()
+    with _PL_CACHE["lock"]:
+        stale = force or mtime != _PL_CACHE["mtime"]
+        if not stale or _PL_CACHE["scanning"]:
+            return _PL_CACHE["files"]
+        _PL_CACHE["scanning"] = True
+    try:
+        files, dirs = _scan_tracks()
+        with _PL_CACHE["lock"]:
+            changed = _store_scan(files, mtime, dirs)
+            version = _PL_CACHE["version"]
+        _save_disk_cache(files, mtime, dirs)
+    finally:
+        with _PL_CACHE["lock"]:
+            _PL_CACHE["scanning"] = False
+    if changed:
+        _broadcast_event("library", {"version": version})
+    return files
+
+_rescan_wake = threading.Event()  # set to make _watch_dirs check the library now
+
+def _poke_library() -> None:
+    """One stat of MUSIC_DIR; if its mtime moved, wake _watch_dirs to rescan rather than
+    walking on the request that noticed."""
+    if _music_mtime() != _PL_CACHE["mtime"]:
+        _rescan_wake.set()
+
+def track_set() -> frozenset:
+    """Cached set of valid track paths; never walks (see _poke_library)."""
+    _poke_library()
+    return _PL_CACHE["set"]
+
+def _norm_track(t: str) -> str:
+    """Match the separator convention used in the library cache."""
+    return t.replace("\\", "/")
+
+def _index_tracks(tracks: List[str]) -> Tuple[Dict[str, List[str]], List[Tuple[str, str]]]:
+    """One pass over the sorted track list: (by top-level folder, (path, path.lower()) pairs).
+    Buckets fill in input order, so they come out sorted; only the folder keys are sorted.
+    The lowered pairs follow the same folder order, so search matches the library view."""
     by: Dict[str, List[str]] = {}
-    for t in discover_tracks():
-        parts = t.split("/")
-        folder = parts[0] if len(parts) > 1 else ""
-        by.setdefault(folder, []).append(t)
-    for k in by:
-        by[k].sort(key=str.lower)
+    for t in tracks:
+        i = t.find("/")
+        by.setdefault(t[:i] if i >= 0 else "", []).append(t)
     keys = sorted(by.keys(), key=lambda x: (x != "", x.lower()))
-    return {k: by[k] for k in keys}
+    lower = [(t, t.lower()) for k in keys for t in by[k]]
+    return {k: by[k] for k in keys}, lower
+
+def library_ndjson() -> Tuple[str, List[bytes]]:
+    """(etag, NDJSON lines) for the current scan; both change only when the library does."""
+    _poke_library()
+    with _PL_CACHE["lock"]:
+        return f"{_BOOT_ID}-{_PL_CACHE['version']}", _PL_CACHE["ndjson"]
+
+SEARCH_LIMIT = 200  # most results /search returns
+
+def search_tracks(q: str) -> Tuple[List[str], bool]:
+    """Tracks whose path contains q (case-insensitive), in library order, at most SEARCH_LIMIT;
+    the flag says whether more matches were cut off."""
+    _poke_library()
+    q = q.lower()
+    hits = list(islice((t for t, tl in _PL_CACHE["lower"] if q in tl), SEARCH_LIMIT + 1))
+    return hits[:SEARCH_LIMIT], len(hits) > SEARCH_LIMIT
+
+# ---------- On-disk library cache ----------
+# The last scan is persisted so a restart can answer /library immediately; a
+# background rescan then picks up anything that changed while we were down.
+def _save_disk_cache(files: List[str], mtime: float, dirs: Dict[str, float]) -> None:
+    data = _dumps({"root": str(MUSIC_DIR), "mtime": mtime, "dirs": dirs, "files": files})
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=str(CACHE_FILE.parent), prefix=CACHE_FILE.name, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, CACHE_FILE)
+        tmp = None
+    except OSError as e:
+        print(f"Could not write library cache {CACHE_FILE}: {e}")
+    finally:
+        if tmp is not None:  # write or replace failed (or we are being torn down): don't leave it behind
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
 
-def _broadcast_event(ev_type: str, payload: Dict[str, Any]) -> None:
-    """Put an event (type + JSON) into every listener queue."""
-    s = json.dumps({"type": ev_type, **payload} if ev_type == "state" else {"type": ev_type, **payload})
-    stale: List[queue.Queue] = []
-    for q in list(_listeners):
-        try:
-            q.put_nowait((ev_type, s))
-        except Exception:
-            stale.append(q)
-    for q in stale:
+def _load_disk_cache() -> None:
+    try:
+        data = _loads(CACHE_FILE.read_bytes())
+    except (OSError, ValueError):
+        return
+    if not isinstance(data, dict) or data.get("root") != str(MUSIC_DIR):
+        return
+    files = data.get("files")
+    if not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+        return
+    mtime = data.get("mtime", -1.0)
+    if not isinstance(mtime, (int, float)) or isinstance(mtime, bool):
+        return
+    dirs = data.get("dirs")
+    if not isinstance(dirs, dict):
+        dirs = {}  # older cache file: the first directory check rescans
+    with _PL_CACHE["lock"]:
+        _store_scan(files, float(mtime), dirs)
+
+def _watch_dirs() -> None:
+    """Rescan off the request path when _poke_library wakes it (MUSIC_DIR's mtime moved).
+    The first pass, and one every DIR_CHECK_INTERVAL if set, also re-stats every scanned
+    directory (without the cache lock) and rescans if any changed."""
+    deep = True
+    while True:
+        _rescan_wake.clear()
         try:
-            _listeners.remove(q)
-        except ValueError:
-            pass
+            discover_tracks(force=deep and _dirs_changed(_PL_CACHE["dirs"]))
+        except Exception as e:  # keep watching; the next pass retries
+            print(f"Library scan failed: {e!r}")
+        deep = not _rescan_wake.wait(DIR_CHECK_INTERVAL)  # timed out: time for a deep check
+
+def _background_rescan() -> None:
+    threading.Thread(target=_watch_dirs, daemon=True).start()
+
+def _broadcast_encoded(ev_type: str, s: bytes) -> None:
+    """Frame an already-encoded event once, append it to the event log and wake every stream."""
+    global _events_seq
+    frame = _sse_frame(ev_type, s)
+    with _events_cond:
+        _events_seq += 1
+        _events.append((_events_seq, frame))
+        _events_cond.notify_all()
+
+def _events_after(cursor: int, timeout: Optional[float]) -> Tuple[int, Optional[List[Tuple[int, bytes]]]]:
+    """Wait for events newer than cursor. Returns (new cursor, events); events is
+    [] on timeout and None if the client fell behind the log and must resync."""
+    with _events_cond:
+        _events_cond.wait_for(lambda: _events_seq > cursor, timeout)
+        behind = _events_seq - cursor
+        if behind == 0:
+            return cursor, []
+        if behind > len(_events):
+            return _events_seq, None
+        return _events_seq, list(islice(_events, len(_events) - behind, None))
 
-def _set_state(track: Optional[str] = None, paused: Optional[bool] = None, position: Optional[float] = None) -> Dict[str, Any]:
-    """Update global playback state and broadcast it."""
-    global _track_started_at
+def _broadcast_event(ev_type: str, payload: Dict[str, Any]) -> None:
+    """Encode an event (type + JSON) once and broadcast it."""
+    _broadcast_encoded(ev_type, _dumps({"type": ev_type, **payload}))
+
+def _state_event(track: Optional[str], paused: bool, position: float, updated: float, epoch: int) -> Dict[str, Any]:
+    """The fixed-shape state event."""
+    return {"type": "state", "track": track, "paused": paused, "position": position,
+            "updated": updated, "epoch": epoch}
+
+def _state_json() -> bytes:
+    """Current state event as JSON, lock-free. The published encoding is reused
+    unless the playhead is moving, in which case the live position is filled in."""
+    ref = _STATE_REF
+    if ref.started_at is None:
+        return ref.encoded
+    return _dumps(_state_event(ref.track, ref.paused, max(0.0, time.monotonic() - ref.started_at),
+                               ref.updated, ref.epoch))
+
+def _set_state(track: Optional[str] = None, paused: Optional[bool] = None, position: Optional[float] = None,
+               end_track: bool = False) -> Dict[str, Any]:
+    """Update global playback state and broadcast it. The playhead is kept as an
+    anchor: STATE["position"] while paused, else _track_started_at (monotonic).
+    end_track bumps the epoch without a new track, so /ended reports for it go stale."""
+    global _track_started_at, _STATE_REF, _state_seq, _state_published, _state_key
+    if track is not None:
+        # against the cached set only: callers may hold playlist_lock, so no stat or walk here
+        track = _norm_track(track)
+        if track not in _PL_CACHE["set"]:
+            raise FileNotFoundError(track)
+    now = time.monotonic()
     with state_lock:
+        pos = STATE["position"] if _track_started_at is None else max(0.0, now - _track_started_at)
         if track is not None:
-            if track not in discover_tracks():
-                raise FileNotFoundError(track)
             STATE["track"] = track
-            STATE["position"] = 0.0 if position is None else float(position)
-            STATE["paused"] = False if paused is None else paused
-            _track_started_at = None if STATE["paused"] else time.time() - STATE["position"]
-        if paused is not None and track is None:
-            if STATE["track"] is None:
-                STATE["paused"] = True
-            else:
-                if paused and not STATE["paused"]:
-                    if _track_started_at is not None:
-                        STATE["position"] += max(0.0, time.time() - _track_started_at)
-                        _track_started_at = None
-                if not paused and STATE["paused"]:
-                    _track_started_at = time.time() - STATE["position"]
-                STATE["paused"] = paused
-        if position is not None and track is None:
-            STATE["position"] = max(0.0, float(position))
-            if not STATE.get("paused", False):
-                _track_started_at = time.time() - STATE["position"]
-        if not STATE.get("paused", False) and _track_started_at is not None:
-            STATE["position"] = max(0.0, time.time() - _track_started_at)
+            STATE["epoch"] += 1
+            pos = 0.0
+            if paused is None:
+                paused = False
+        elif end_track:
+            STATE["epoch"] += 1
+        if position is not None:
+            pos = max(0.0, float(position))
+        if paused is not None:
+            STATE["paused"] = paused or STATE["track"] is None
+        STATE["position"] = pos
+        _track_started_at = None if STATE["paused"] else now - pos
+        # skip no-op updates (pause while paused, seek to the same spot): nothing to tell listeners
+        key = (STATE["track"], STATE["paused"], STATE["epoch"],
+               round(pos if _track_started_at is None else _track_started_at, 1))
+        if key == _state_key:
+            return STATE.copy()
+        _state_key = key
         STATE["updated"] = time.time()
-        snapshot = STATE.copy()
-    _broadcast_event("state", snapshot)
+        _state_seq += 1
+        seq, started_at, snapshot = _state_seq, _track_started_at, STATE.copy()
+    # encode outside state_lock; publish under the event log's lock in mutation
+    # order, dropping a slower writer that a newer update already superseded
+    payload = _dumps(_state_event(snapshot["track"], snapshot["paused"], snapshot["position"],
+                                  snapshot["updated"], snapshot["epoch"]))
+    with _events_cond:
+        if seq > _state_published:
+            _state_published = seq
+            _STATE_REF = _StateRef(snapshot["track"], snapshot["paused"], snapshot["position"],
+                                  snapshot["updated"], snapshot["epoch"], started_at, seq, payload)
+            _broadcast_encoded("state", payload)  # re-enters _events_cond (an RLock)
     return snapshot
 
 # ---------- Playlist helpers ----------
-def _broadcast_playlist() -> None:
-    _broadcast_event("playlist", {"queue": PLAYLIST_QUEUE})
+# playlist_lock covers read -> mutate -> broadcast so concurrent /queue/* and /ended
+# calls cannot interleave. Broadcasting under it is cheap (an append to the event log)
+# and keeps playlist events in mutation order. Lock order: playlist_lock, then state_lock.
+playlist_lock = threading.Lock()
+
+def _broadcast_playlist() -> List[str]:
+    """Announce a queue change and bump the /playlist ETag revision; caller holds playlist_lock."""
+    global _QUEUE_REV, _PLAYLIST_JSON
+    _QUEUE_REV += 1
+    snapshot = list(PLAYLIST_QUEUE)
+    _PLAYLIST_JSON = _dumps({"type": "playlist", "queue": snapshot})
+    _broadcast_encoded("playlist", _PLAYLIST_JSON)
+    return snapshot
 
-def add_to_queue(items: List[str], shuffle: bool = False) -> None:
-    valid = [t for t in items if t in discover_tracks()]
-    if shuffle:
-        random.shuffle(valid)
-    PLAYLIST_QUEUE.extend(valid)
-    _broadcast_playlist()
-    # if nothing playing, start the first
-    if STATE.get("track") is None and PLAYLIST_QUEUE:
-        nxt = PLAYLIST_QUEUE.pop(0)
-        _set_state(track=nxt, paused=False, position=0.0)
+def _playlist_etag() -> str:
+    return f"{_BOOT_ID}-{_QUEUE_REV}"
 
-def remove_from_queue(idx: int) -> None:
-    if 0 <= idx < len(PLAYLIST_QUEUE):
-        PLAYLIST_QUEUE.pop(idx)
-        _broadcast_playlist()
+def queue_snapshot() -> Tuple[str, List[str]]:
+    """(etag, queue copy) taken together so they always match."""
+    with playlist_lock:
+        return _playlist_etag(), list(PLAYLIST_QUEUE)
+
+NUMPY_SHUFFLE_MIN = 4096  # longer lists are shuffled with numpy when it is installed
 
-def clear_queue() -> None:
-    PLAYLIST_QUEUE.clear()
-    _broadcast_playlist()
+def _shuffled(items: List[str], seed: Optional[int]) -> List[str]:
+    """Shuffle items (in place unless numpy is used); the same seed gives the same order
+    on every install. Seeded shuffles therefore always use random.Random, since numpy's
+    generator would order the same seed differently depending on whether it is installed
+    and on the list length."""
+    if seed is None and len(items) > NUMPY_SHUFFLE_MIN:
+        try:
+            import numpy as np  # optional, only imported for large shuffles
+        except ImportError:
+            pass
+        else:
+            return [items[i] for i in np.random.default_rng().permutation(len(items)).tolist()]
+    (random.Random(seed) if seed is not None else random).shuffle(items)
+    return items
+
+def add_to_queue(items: List[str], shuffle: bool = False, seed: Optional[int] = None) -> List[str]:
+    """Append known tracks, each at most once per call. A seed makes the shuffle reproducible."""
+    known = track_set()
+    # dict.fromkeys drops repeats within this add while keeping order
+    valid = [t for t in dict.fromkeys(_norm_track(i) for i in items if isinstance(i, str)) if t in known]
+    if shuffle:
+        valid = _shuffled(valid, seed)
+    with playlist_lock:
+        PLAYLIST_QUEUE.extend(valid)
+        # if nothing playing, start the first
+        nxt = PLAYLIST_QUEUE.popleft() if _STATE_REF.track is None and PLAYLIST_QUEUE else None
+        snapshot = _broadcast_playlist()
+        if nxt:
+            # still under playlist_lock so a concurrent add can't also auto-start
+            _set_state(track=nxt, paused=False, position=0.0)
+    return snapshot
 
-def pop_next() -> Optional[str]:
-    if PLAYLIST_QUEUE:
-        nxt = PLAYLIST_QUEUE.pop(0)
+def remove_from_queue(idx: int) -> List[str]:
+    with playlist_lock:
+        if 0 <= idx < len(PLAYLIST_QUEUE):
+            del PLAYLIST_QUEUE[idx]
+            return _broadcast_playlist()
+        return list(PLAYLIST_QUEUE)
+
+def clear_queue() -> List[str]:
+    with playlist_lock:
+        PLAYLIST_QUEUE.clear()
+        return _broadcast_playlist()
+
+def play_next(epoch: Optional[int] = None) -> Tuple[bool, Optional[str]]:
+    """Start the next queued track, or pause if the queue is empty. With an epoch,
+    only advance if it still names the current track, so several listeners
+    reporting the same end advance once. Returns (advanced, now playing)."""
+    with playlist_lock:
+        if epoch is not None and epoch != _STATE_REF.epoch:
+            return False, _STATE_REF.track
+        if not PLAYLIST_QUEUE:
+            # a new epoch: late /ended reports for this same end must not start what gets queued next
+            _set_state(paused=True, position=0.0, end_track=True)
+            return True, None
+        nxt = PLAYLIST_QUEUE.popleft()
         _broadcast_playlist()
-        return nxt
-    return None
+        _set_state(track=nxt, paused=False, position=0.0)
+        return True, nxt
+
+def _check_admin() -> bool:
+    """True if no ADMIN_TOKEN is set or the request carries it (query, X-Admin-Token header, or JSON body)."""
+    if not ADMIN_TOKEN:
+        return True
+    t = request.args.get("token") or request.headers.get("X-Admin-Token")
+    if not t:
+        t = g.body.get("token")
+    return isinstance(t, str) and hmac.compare_digest(t.encode(), ADMIN_TOKEN.encode())
+
+def require_admin(f):
+    """Route decorator: 403 unless _check_admin() passes."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not _check_admin():
+            abort(403)
+        return f(*args, **kwargs)
+    return wrapper
 
 # ---------- API routes ----------
+@app.before_request
+def _parse_body():
+    # parse the JSON body once per request; handlers read g.body
+    body = None
+    if request.method == "POST" and request.mimetype == "application/json":
+        raw = request.get_data(cache=False)
+        try:
+            body = _loads(raw) if raw else None
+        except ValueError:  # both decoders' errors subclass it
+            body = None
+    g.body = body if isinstance(body, dict) else {}
+
 @app.get("/library")
 def api_library():
-    return jsonify(library_by_folder())
+    # NDJSON, one {"folder", "tracks"} per line, encoded once per rescan and
+    # written line by line so the control page can render as folders arrive
+    etag, lines = library_ndjson()
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(lines, mimetype="application/x-ndjson")
+    resp.set_etag(etag, weak=True)
+    return resp
+
+STREAM_BATCH = 512  # items per chunk when streaming large JSON arrays
+
+def _stream_json_list(key: str, items: List[str]):
+    """Yield {"<key>": [...]} in chunks so a long list is never encoded as one blob."""
+    yield b'{"' + key.encode() + b'":['
+    for i in range(0, len(items), STREAM_BATCH):
+        chunk = b",".join(_dumps(t) for t in items[i:i + STREAM_BATCH])
+        yield chunk if i == 0 else b"," + chunk
+    yield b"]}"
+
+GZIP_MIN_ITEMS = 64  # below this a list response is sent uncompressed
+
+def _gzip_stream(chunks):
+    """Gzip a chunk iterator on the fly (level 1: cheap, and paths compress well)."""
+    z = zlib.compressobj(1, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+def _list_response(key: str, items: List[str]) -> Response:
+    body = _stream_json_list(key, items)
+    if len(items) >= GZIP_MIN_ITEMS and "gzip" in request.accept_encodings:
+        resp = Response(_gzip_stream(body), mimetype="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+@app.get("/search")
+def api_search():
+    q = request.args.get("q", "").strip()
+    results, truncated = search_tracks(q) if len(q) >= 2 else ([], False)
+    return _json_response({"results": results, "truncated": truncated})
 
 @app.get("/playlist")
 def api_playlist():
-    return jsonify({"queue": PLAYLIST_QUEUE})
+    etag, items = queue_snapshot()
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = _list_response("queue", items)
+    resp.set_etag(etag, weak=True)
+    return resp
 
 @app.post("/queue/add")
+@require_admin
 def api_queue_add():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    body = request.get_json(silent=True) or {}
-    items = body.get("items") or []
-    shuffle = bool(body.get("shuffle", False))
-    add_to_queue(items, shuffle=shuffle)
-    return jsonify({"queue": PLAYLIST_QUEUE})
+    # body: {"items": [...], "shuffle": bool, "seed": int (optional, same seed -> same order)}
+    items = g.body.get("items") or []
+    shuffle = bool(g.body.get("shuffle", False))
+    seed = g.body.get("seed")
+    if not isinstance(seed, int) or isinstance(seed, bool):
+        seed = None
+    return _json_response({"queue": add_to_queue(items, shuffle=shuffle, seed=seed)})
 
 @app.post("/queue/clear")
+@require_admin
 def api_queue_clear():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    clear_queue()
-    return jsonify({"queue": PLAYLIST_QUEUE})
+    return _json_response({"queue": clear_queue()})
 
 @app.post("/queue/remove")
+@require_admin
 def api_queue_remove():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    body = request.get_json(silent=True) or {}
-    idx = int(body.get("index", -1))
-    remove_from_queue(idx)
-    return jsonify({"queue": PLAYLIST_QUEUE})
+    idx = int(g.body.get("index", -1))
+    return _json_response({"queue": remove_from_queue(idx)})
 
 @app.post("/queue/next")
+@require_admin
 def api_queue_next():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    nxt = pop_next()
-    if nxt:
-        _set_state(track=nxt, paused=False, position=0.0)
-        return jsonify({"playing": nxt})
-    _set_state(track=None, paused=True, position=0.0)
-    return jsonify({"playing": None})
+    _, nxt = play_next()
+    return _json_response({"playing": nxt})
 
 @app.post("/ended")
 def api_ended():
-    # client reports end -> server pops next
-    nxt = pop_next()
-    if nxt:
-        _set_state(track=nxt, paused=False, position=0.0)
-        return jsonify({"playing": nxt})
-    _set_state(track=None, paused=True, position=0.0)
-    return jsonify({"playing": None})
+    # client reports end with the epoch it was playing -> server advances once per epoch
+    epoch = g.body.get("epoch")
+    advanced, nxt = play_next(epoch if isinstance(epoch, int) and not isinstance(epoch, bool) else None)
+    if not advanced:
+        return _json_response({"ignored": True, "playing": nxt})
+    return _json_response({"playing": nxt})
+
+@app.post("/rescan")
+@require_admin
+def api_rescan():
+    tracks = discover_tracks(force=True)
+    return _json_response({"tracks": len(tracks)})
+
+MEDIA_MAX_AGE = 3600  # seconds browsers may reuse a track before revalidating
 
 @app.get("/media/<path:filename>")
 def media(filename: str):
-    safe = Path(filename)
-    file_path = MUSIC_DIR / safe
-    if not file_path.exists() or file_path.suffix.lower() not in AUDIO_EXTS:
+    # only paths the scanner discovered are served; this also rules out ../ traversal
+    if filename not in track_set():
+        abort(404)
+    mime = AUDIO_MIME.get(filename[filename.rfind("."):].lower(), "application/octet-stream")
+    if MEDIA_ACCEL_PREFIX:
+        # nginx serves the bytes (and the Range requests); advertise ranges so seeking works
+        return Response(headers={"X-Accel-Redirect": MEDIA_ACCEL_PREFIX + quote(filename), "Content-Type": mime,
+                                 "Accept-Ranges": "bytes", "Cache-Control": f"public, max-age={MEDIA_MAX_AGE}"})
+    # the set check above already did what send_from_directory's safe_join + isfile
+    # would, so go straight to send_file: one stat, Range -> 206, ETag/Last-Modified;
+    # max_age spares replays a revalidation
+    try:
+        return send_file(os.path.join(MUSIC_DIR, filename), mimetype=mime, conditional=True,
+                         max_age=MEDIA_MAX_AGE)
+    except FileNotFoundError:  # deleted since the last scan
         abort(404)
-    # send_from_directory handles nested paths correctly
-    return send_from_directory(MUSIC_DIR, filename, as_attachment=False)
 
 @app.get("/state")
 def api_state():
-    with state_lock:
-        snap = STATE.copy()
-        # update position if playing
-        global _track_started_at
-        if not snap.get("paused", False) and _track_started_at is not None:
-            snap["position"] = max(0.0, time.time() - _track_started_at)
-    return jsonify(snap)
+    ref = _STATE_REF
+    if ref.started_at is not None:
+        # playing: the body carries the live position, so there is nothing to revalidate
+        return Response(_state_json(), mimetype="application/json")
+    etag = f"{_BOOT_ID}-{ref.rev}"
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(ref.encoded, mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    return resp
 
 # ---------- SSE events ----------
+_SSE_PREFIX = {t: f"event: {t}\ndata: ".encode() for t in ("state", "playlist", "library")}
+_SSE_SUFFIX = b"\n\n"
+_SSE_KEEPALIVE_FRAME = b": keepalive\n\n"
+_SSE_RESYNC_FRAME = b'event: resync\ndata: {"type":"resync"}\n\n'  # client missed events; refetch what it shows
+SSE_KEEPALIVE = 15.0  # seconds of silence before a keepalive comment is sent
+
+def _sse_frame(ev_type: str, payload: bytes) -> bytes:
+    """One complete SSE frame, so each event is a single write."""
+    prefix = _SSE_PREFIX.get(ev_type) or f"event: {ev_type}\ndata: ".encode()
+    return prefix + payload + _SSE_SUFFIX
+
+def _nodelay() -> None:
+    """Turn off Nagle on this request's connection (dev server exposes the socket) so small frames go out at once."""
+    sock = request.environ.get("werkzeug.socket")
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
 @app.get("/events")
 def sse_events():
-    q: queue.Queue = queue.Queue()
-    _listeners.append(q)
+    _nodelay()
+    # take the cursor before the initial snapshot so nothing in between is missed
+    with _events_cond:
+        cursor = _events_seq
 
     def stream():
-        # initial events
-        with state_lock:
-            init_state = STATE.copy()
-        init_pl = {"queue": PLAYLIST_QUEUE}
-        # yield named events
-        yield f"event: state\n"
-        yield f"data: {json.dumps({'type': 'state', **init_state})}\n\n"
-        yield f"event: playlist\n"
-        yield f"data: {json.dumps({'type': 'playlist', **init_pl})}\n\n"
-        try:
-            while True:
-                ev_type, payload = q.get()
-                # payload is a JSON string already with {"type":..., ...}
-                yield f"event: {ev_type}\n"
-                yield f"data: {payload}\n\n"
-        except GeneratorExit:
-            try:
-                _listeners.remove(q)
-            except ValueError:
-                pass
-
-    headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "Connection": "keep-alive"}
+        nonlocal cursor
+        # initial events, from the already-encoded current state and playlist
+        yield _sse_frame("state", _state_json())
+        yield _sse_frame("playlist", _PLAYLIST_JSON)
+        while True:
+            cursor, items = _events_after(cursor, SSE_KEEPALIVE)
+            if items is None:
+                yield _SSE_RESYNC_FRAME
+            elif not items:
+                # comment line: ignored by EventSource, keeps proxies from idling us out
+                yield _SSE_KEEPALIVE_FRAME
+            else:
+                # state events are full snapshots: a listener catching up on a
+                # backlog only needs the newest one
+                state_prefix = _SSE_PREFIX["state"]
+                last_state = max((i for i, (_, f) in enumerate(items) if f.startswith(state_prefix)), default=-1)
+                for i, (_, frame) in enumerate(items):
+                    if i < last_state and frame.startswith(state_prefix):
+                        continue
+                    # shared, pre-framed bytes: no per-listener formatting
+                    yield frame
+
+    # X-Accel-Buffering: stop nginx from holding frames back when proxied
+    headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "Connection": "keep-alive",
+               "X-Accel-Buffering": "no"}
     return Response(stream(), headers=headers)
 
 # ---------- Playback control endpoints ----------
 @app.post("/play")
+@require_admin
 def api_play():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    body = request.get_json(silent=True) or {}
-    track = body.get("track")
-    pos = body.get("position")
-    if not track:
+    track = g.body.get("track")
+    pos = g.body.get("position")
+    if not track or not isinstance(track, str):
         abort(400, "Missing track")
-    _set_state(track=track, paused=False, position=pos)
-    return jsonify(STATE)
+    try:
+        snap = _set_state(track=track, paused=False, position=pos)
+    except FileNotFoundError:
+        abort(404, "Unknown track")
+    return _json_response(snap)
 
 @app.post("/pause")
+@require_admin
 def api_pause():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    body = request.get_json(silent=True) or {}
-    paused = bool(body.get("paused", True))
-    _set_state(paused=paused)
-    return jsonify(STATE)
+    paused = bool(g.body.get("paused", True))
+    snap = _set_state(paused=paused)
+    return _json_response(snap)
+
+# Slider drags produce bursts of /seek: the first is applied at once, later ones within
+# SEEK_COALESCE of the last applied seek collapse into a single deferred one.
+SEEK_COALESCE = 0.12  # seconds
+_seek_lock = threading.Lock()
+_seek_pending: Optional[Tuple[float, int]] = None  # (position, epoch) waiting for the timer
+_seek_last = float("-inf")  # time.monotonic() of the last applied seek
+
+def _flush_seek() -> None:
+    global _seek_pending, _seek_last
+    with _seek_lock:
+        pending, _seek_pending = _seek_pending, None
+        _seek_last = time.monotonic()
+    # dropped if the track changed while it waited
+    if pending is not None and pending[1] == _STATE_REF.epoch:
+        _set_state(position=pending[0])
+
+def request_seek(pos: float) -> Optional[Dict[str, Any]]:
+    """Seek now, or shortly if a seek was just applied. Returns the new state if applied now."""
+    global _seek_pending, _seek_last
+    now = time.monotonic()
+    with _seek_lock:
+        if _seek_pending is None and now - _seek_last >= SEEK_COALESCE:
+            _seek_last = now
+        else:
+            if _seek_pending is None:
+                t = threading.Timer(max(0.0, SEEK_COALESCE - (now - _seek_last)), _flush_seek)
+                t.daemon = True
+                t.start()
+            _seek_pending = (pos, _STATE_REF.epoch)
+            return None
+    return _set_state(position=pos)
 
 @app.post("/seek")
+@require_admin
 def api_seek():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
-        abort(403)
-    body = request.get_json(silent=True) or {}
-    pos = float(body.get("position", 0.0))
-    _set_state(position=pos)
-    return jsonify(STATE)
+    pos = float(g.body.get("position", 0.0))
+    snap = request_seek(pos)
+    if snap is None:
+        # coalesced: report the position that is about to be applied
+        ref = _STATE_REF
+        snap = {"track": ref.track, "paused": ref.paused, "position": max(0.0, pos),
+                "updated": ref.updated, "epoch": ref.epoch, "pending": True}
+    return _json_response(snap)
 
 # ---------- Pages (templates inline) ----------
 INDEX_HTML = r"""
@@ -343,35 +861,40 @@ function buildMediaUrl(track){
   return '/media/' + track.split('/').map(encodeURIComponent).join('/');
 }
 
+let curEpoch = null;
+let curTrack = null;
+
 function applyState(s){
-  title.textContent = s.track || 'No track selected';
-  if(!s.track){
-    player.removeAttribute('src');
-    return;
-  }
-  const url = buildMediaUrl(s.track);
-  if(!player.src || !player.src.includes(url)){
-    player.src = url;
+  curEpoch = s.epoch;
+  // only touch the audio element for fields that actually changed
+  if(s.track !== curTrack){
+    curTrack = s.track;
+    title.textContent = s.track || 'No track selected';
+    if(s.track) player.src = buildMediaUrl(s.track); else player.removeAttribute('src');
   }
-  // always try to align to server position
-  const trySeek = ()=>{ try{ if(Math.abs(player.currentTime - s.position) > 0.8) player.currentTime = s.position; }catch(e){} };
+  if(!s.track) return;
+  // align to server position only when noticeably off
+  const trySeek = ()=>{ try{ if(Math.abs(player.currentTime - s.position) > 1.0) player.currentTime = s.position; }catch(e){} };
   if(player.readyState >= 1) trySeek(); else player.onloadedmetadata = trySeek;
-  if(s.paused) player.pause(); else player.play().catch(()=>{});
+  if(s.paused){ if(!player.paused) player.pause(); }
+  else if(player.paused) player.play().catch(()=>{});
 }
 
-player.onended = ()=>{ fetch('/ended', {method:'POST'}).catch(()=>{}); };
+player.onended = ()=>{ fetch('/ended', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({epoch: curEpoch})}).catch(()=>{}); };
 
 const es = new EventSource('/events');
 es.addEventListener('state', e => { const d = JSON.parse(e.data); applyState(d); });
 es.addEventListener('playlist', e => { const d = JSON.parse(e.data); renderQueue(d.queue); });
 
-// initial fetch (in case SSE missed anything)
-(async ()=>{
+// initial fetch (in case SSE missed anything); also run when the server says we fell behind
+async function resync(){
   const s = await (await fetch('/state')).json();
   applyState(s);
   const pl = await (await fetch('/playlist')).json();
   renderQueue(pl.queue);
-})();
+}
+es.addEventListener('resync', ()=>{ resync().catch(()=>{}); });
+resync();
 </script>
 </body>
 </html>
@@ -458,13 +981,35 @@ const fmt = s => { s = Math.max(0, Math.floor(s||0)); const m=Math.floor(s/60);
 const mediaUrl = track => '/media/' + track.split('/').map(encodeURIComponent).join('/');
 
 let STATE = {track:null, paused:true, position:0};
+let stateAt = 0, lastSec = -1;  // when STATE arrived (performance.now()), last second the ticker drew
 let LIB = {};
 
 async function loadLibrary(){
+  // NDJSON: one {folder, tracks} per line, rendered as each line arrives
   const res = await fetch('/library');
-  LIB = await res.json();
-  renderLibrary();
-  renderSearchResults(); // in case there's active search
+  const el = $('#library'); el.innerHTML='';
+  LIB = {};
+  const addLine = line => {
+    if(!line) return;
+    const f = JSON.parse(line);
+    LIB[f.folder] = f.tracks;
+    appendFolder(el, f.folder);
+  };
+  if(res.body && res.body.getReader){
+    const reader = res.body.getReader(); const dec = new TextDecoder();
+    let buf = '';
+    for(;;){
+      const {done, value} = await reader.read();
+      if(done) break;
+      buf += dec.decode(value, {stream:true});
+      const lines = buf.split('\n'); buf = lines.pop();
+      lines.forEach(addLine);
+    }
+    addLine(buf + dec.decode());
+  } else {
+    (await res.text()).split('\n').forEach(addLine);
+  }
+  renderSearchResults($('#searchInput').value).catch(()=>{}); // in case there's active search
 }
 async function loadQueue(){
   const res = await fetch('/playlist');
@@ -474,35 +1019,30 @@ async function loadQueue(){
 async function loadState(){ const s = await (await fetch('/state')).json(); applyState(s); }
 
 /* Renderers */
-function renderLibrary(){
-  const el = $('#library'); el.innerHTML='';
-  for(const folder in LIB){
-    const group = document.createElement('div'); group.className='folder';
-    const header = document.createElement('div');
-    header.innerHTML = `<strong>${folder || 'root'}</strong> <button class="btn ghost" data-folder="${folder}" data-action="addAll">Add All</button> <button class="btn ghost" data-folder="${folder}" data-action="shuffleAll">Shuffle</button>`;
-    group.appendChild(header);
-    LIB[folder].forEach(t=>{
-      const tr = document.createElement('div'); tr.className='track';
-      tr.innerHTML = `<div class="small">${t.split('/').pop()}</div>`;
-      const right = document.createElement('div');
-      const add = document.createElement('button'); add.className='btn-sm'; add.textContent='Add';
-      add.onclick = ()=> queueAdd([t], false);
-      right.appendChild(add);
-      tr.appendChild(right);
-      group.appendChild(tr);
-    });
-    el.appendChild(group);
-  }
+function appendFolder(el, folder){
+  const group = document.createElement('div'); group.className='folder';
+  const header = document.createElement('div');
+  header.innerHTML = `<strong>${folder || 'root'}</strong> <button class="btn ghost" data-folder="${folder}" data-action="addAll">Add All</button> <button class="btn ghost" data-folder="${folder}" data-action="shuffleAll">Shuffle</button>`;
+  group.appendChild(header);
+  LIB[folder].forEach(t=>{
+    const tr = document.createElement('div'); tr.className='track';
+    tr.innerHTML = `<div class="small">${t.split('/').pop()}</div>`;
+    const right = document.createElement('div');
+    const add = document.createElement('button'); add.className='btn-sm'; add.textContent='Add';
+    add.onclick = ()=> queueAdd([t], false);
+    right.appendChild(add);
+    tr.appendChild(right);
+    group.appendChild(tr);
+  });
   // attach folder-level handlers
-  el.querySelectorAll('[data-action]').forEach(btn=>{
+  header.querySelectorAll('[data-action]').forEach(btn=>{
     btn.onclick = ()=>{
-      const folder = btn.dataset.folder;
-      const action = btn.dataset.action;
       const items = LIB[folder] || [];
-      if(action === 'addAll') queueAdd(items, false);
+      if(btn.dataset.action === 'addAll') queueAdd(items, false);
       else queueAdd(items, true);
     };
   });
+  el.appendChild(group);
 }
 
 function renderQueue(q){
@@ -524,21 +1064,28 @@ function renderQueue(q){
   });
 }
 
-function renderSearchResults(term){
-  const out = $('#searchResults'); out.innerHTML='';
-  if(!term || term.length < 2) return;
-  const lowered = term.toLowerCase();
-  for(const folder in LIB){
-    LIB[folder].forEach(t=>{
-      if(t.toLowerCase().includes(lowered)){
-        const row = document.createElement('div'); row.style.display='flex'; row.style.justifyContent='space-between'; row.style.padding='6px 0';
-        row.innerHTML = `<div class="small">${t}</div>`;
-        const b = document.createElement('button'); b.className='btn-sm'; b.textContent='Add';
-        b.onclick = ()=> queueAdd([t], false);
-        row.appendChild(b);
-        out.appendChild(row);
-      }
-    });
+// matching runs on the server (/search); only the newest request's results are shown
+let searchSeq = 0;
+async function renderSearchResults(term){
+  const out = $('#searchResults');
+  const seq = ++searchSeq;
+  term = (term || '').trim();
+  if(term.length < 2){ out.innerHTML=''; return; }
+  const d = await (await fetch('/search?q=' + encodeURIComponent(term))).json();
+  if(seq !== searchSeq) return;
+  out.innerHTML='';
+  d.results.forEach(t=>{
+    const row = document.createElement('div'); row.style.display='flex'; row.style.justifyContent='space-between'; row.style.padding='6px 0';
+    row.innerHTML = `<div class="small">${t}</div>`;
+    const b = document.createElement('button'); b.className='btn-sm'; b.textContent='Add';
+    b.onclick = ()=> queueAdd([t], false);
+    row.appendChild(b);
+    out.appendChild(row);
+  });
+  if(d.truncated){
+    const note = document.createElement('div'); note.className='small'; note.style.padding='6px 0';
+    note.textContent = `Showing first ${d.results.length} matches — refine the search to see more`;
+    out.appendChild(note);
   }
 }
 
@@ -553,17 +1100,21 @@ async function removeFromQueue(idx){ await fetch('/queue/remove',{method:'POST',
 /* State application */
 function applyState(s){
   STATE = s;
-  const player = document.querySelector('audio');
+  stateAt = performance.now(); lastSec = Math.floor(STATE.position || 0);
+  const player = document.querySelector('audio');  // the control page may have none
   if(STATE.track){
-    const url = mediaUrl(STATE.track);
-    if(!player.src || !player.src.includes(url)) player.src = url;
-    try{ if(Math.abs(player.currentTime - STATE.position) > 0.8) player.currentTime = STATE.position; }catch(e){}
-    if(STATE.paused) player.pause(); else player.play().catch(()=>{});
+    if(player){
+      const url = mediaUrl(STATE.track);
+      if(!player.src || !player.src.includes(url)) player.src = url;
+      try{ if(Math.abs(player.currentTime - STATE.position) > 1.0) player.currentTime = STATE.position; }catch(e){}
+      if(STATE.paused){ if(!player.paused) player.pause(); }
+      else if(player.paused) player.play().catch(()=>{});
+    }
     $('#seek').value = Math.floor(STATE.position || 0);
-  } else {
+  } else if(player){
     player.removeAttribute('src');
   }
-  $('#seekTime').textContent = fmt(STATE.position || 0) + " / " + (STATE.track ? (isFinite(player.duration)? fmt(player.duration): '?:??') : '0:00');
+  $('#seekTime').textContent = fmt(STATE.position || 0) + " / " + (STATE.track ? (player && isFinite(player.duration)? fmt(player.duration): '?:??') : '0:00');
 }
 
 /* Wire up controls */
@@ -573,24 +1124,46 @@ $('#clearQueueBtn').onclick = async ()=> { await queueClear(); };
 $('#pauseBtn').onclick = ()=> fetch('/pause',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({paused:true})});
 $('#resumeBtn').onclick = ()=> fetch('/pause',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({paused:false})});
 $('#playNext').onclick = ()=> playNext();
-$('#seek').addEventListener('input', e => { fetch('/seek',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({position: parseFloat(e.target.value)})}); });
-
-$('#searchInput').addEventListener('input', e => { renderSearchResults(e.target.value); });
+// dragging fires 'input' continuously: send at most one seek per 50 ms, plus the final position
+let seekTimer = null, seekPending = null;
+const sendSeek = ()=>{ fetch('/seek',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({position: seekPending})}); seekPending = null; };
+$('#seek').addEventListener('input', e => {
+  seekPending = parseFloat(e.target.value);
+  if(seekTimer) return;
+  sendSeek();
+  seekTimer = setInterval(()=>{ if(seekPending === null){ clearInterval(seekTimer); seekTimer = null; } else sendSeek(); }, 50);
+});
+
+let searchTimer = null;  // debounce: one search per 100 ms pause in typing
+$('#searchInput').addEventListener('input', e => {
+  clearTimeout(searchTimer);
+  const term = e.target.value;
+  searchTimer = setTimeout(()=>{ renderSearchResults(term).catch(()=>{}); }, 100);
+});
 
 /* SSE */
 const sse = new EventSource('/events');
 sse.addEventListener('state', e => { const d = JSON.parse(e.data); applyState(d); });
 sse.addEventListener('playlist', e => { const d = JSON.parse(e.data); renderQueue(d.queue); });
+sse.addEventListener('library', ()=>{ loadLibrary().catch(()=>{}); });
+sse.addEventListener('resync', ()=>{ loadLibrary().catch(()=>{}); loadQueue().catch(()=>{}); loadState().catch(()=>{}); });
 
-/* Tick UI for seek time */
-setInterval(()=>{
-  const p = document.querySelector('audio');
+/* Tick UI for seek time: one rAF loop, position derived from when STATE arrived;
+   the DOM is only written when the displayed second changes */
+const seekEl = $('#seek'), seekTimeEl = $('#seekTime');
+function tick(now){
   if(STATE.track && !STATE.paused){
-    STATE.position = (STATE.position||0) + 1;
-    $('#seek').value = Math.floor(STATE.position);
-    $('#seekTime').textContent = fmt(STATE.position) + " / " + (p && isFinite(p.duration) ? fmt(p.duration) : '?:??');
+    const sec = Math.floor((STATE.position || 0) + (now - stateAt) / 1000);
+    if(sec !== lastSec){
+      lastSec = sec;
+      const p = document.querySelector('audio');
+      seekEl.value = sec;
+      seekTimeEl.textContent = fmt(sec) + " / " + (p && isFinite(p.duration) ? fmt(p.duration) : '?:??');
+    }
   }
-}, 1000);
+  requestAnimationFrame(tick);
+}
+requestAnimationFrame(tick);
 
 /* initial load */
 (async ()=>{
@@ -603,7 +1176,7 @@ setInterval(()=>{
 /* attach onended for audio when it appears */
 new MutationObserver(()=>{
   const p = document.querySelector('audio');
-  if(p) p.onended = ()=> fetch('/ended',{method:'POST'}).catch(()=>{});
+  if(p) p.onended = ()=> fetch('/ended',{method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({epoch: STATE.epoch})}).catch(()=>{});
 }).observe(document.body, {childList:true, subtree:true});
 
 </script>
@@ -611,19 +1184,57 @@ new MutationObserver(()=>{
 </html>
 """
 
-# Serve pages
+# Serve pages (no template variables, so encode once instead of rendering per request)
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_CONTROL_BYTES = CONTROL_HTML.encode("utf-8")
+_INDEX_ETAG = hashlib.md5(_INDEX_BYTES).hexdigest()
+_CONTROL_ETAG = hashlib.md5(_CONTROL_BYTES).hexdigest()
+# compressed once at import (max level: it is paid only once); mtime=0 keeps the bytes stable
+_INDEX_GZ = gzip.compress(_INDEX_BYTES, 9, mtime=0)
+_CONTROL_GZ = gzip.compress(_CONTROL_BYTES, 9, mtime=0)
+PAGE_MAX_AGE = 3600  # seconds browsers may reuse a page before revalidating
+
+def _page_response(body: bytes, gz: bytes, etag: str) -> Response:
+    if "gzip" in request.accept_encodings:
+        resp = Response(gz, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "gzip"
+        etag += "-gz"  # a different representation needs its own tag
+    else:
+        resp = Response(body, mimetype="text/html")
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = PAGE_MAX_AGE
+    return resp.make_conditional(request)
+
 @app.get("/")
 def index_page():
-    return render_template_string(INDEX_HTML)
+    return _page_response(_INDEX_BYTES, _INDEX_GZ, _INDEX_ETAG)
 
 @app.get("/control")
 def control_page():
-    if ADMIN_TOKEN and request.args.get("token") != ADMIN_TOKEN:
+    if not _check_admin():
         return "<h1>🔒 Control Locked</h1><p>Append ?token=YOUR_TOKEN</p>"
-    return render_template_string(CONTROL_HTML)
+    return _page_response(_CONTROL_BYTES, _CONTROL_GZ, _CONTROL_ETAG)
+
+# ---------- Startup ----------
+# at the end of the module so everything the background thread can reach (broadcast,
+# SSE framing) is defined. Runs at import, so WSGI servers get it too.
+_load_disk_cache()
+# warm check: re-stats the directories from the disk cache and walks only if one
+# changed (or there was no cache); after that the thread waits for _poke_library
+_background_rescan()
 
 # ---------- Run ----------
 if __name__ == "__main__":
     print(f"Starting LAN Music Server on http://{HOST}:{PORT}/")
-    app.run(host=HOST, port=PORT, threaded=True)
+    if monkey is not None:
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer((HOST, PORT), app)
+        server.init_socket()
+        # accepted connections inherit TCP_NODELAY from the listener on Linux
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server.serve_forever()
+    else:
+        app.run(host=HOST, port=PORT, threaded=True)
 